@@ -16,71 +16,201 @@ SPDX-License-Identifier: GPL-2.0-or-later
 """
 
 import argparse
+import atexit
 import collections
 import configparser
 import json
 import logging as LOG
 import os
 import pickle
+import queue
 import random
 import re
 import signal
-import sys
+import threading
 import time
-import urllib.parse
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from pathlib import Path
 
 import pika
 import requests
-from pika.adapters.blocking_connection import BlockingChannel
+from pika.channel import Channel
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import dumps as _json_dumps
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode()
+
 
 CONF = configparser.ConfigParser(strict=False)
-OPENQA_GROUPS_FILTER: tuple[int, ...] = (
-    645,
-    623,
-    608,
-    586,
-    582,
-    538,
-    475,
-    453,
-    445,
-    444,
-    443,
-    442,
-    428,
+# settings needed on every event, cached from CONF by cache_config()
+SLACK_URL: str | None = None
+OBS_HOST: str = ''
+OPENQA_HOST: str = ''
+OBS_BUILD_LOG_URL: str = ''
+OBS_REQUEST_URL: str = ''
+OBS_PROJECT_REQUESTS_URL: str = ''
+OBS_REPO_STATE_URL: str = ''
+OPENQA_OVERVIEW_URL: str = ''
+# OBS project names are ASCII, skip the unicode aware matching
+PROJECT_RE: re.Pattern[str] | None = None
+REPO_RE: re.Pattern[str] | None = None
+OPENQA_GROUPS_FILTER: frozenset[int] = frozenset(
+    (645, 623, 608, 586, 582, 538, 475, 453, 445, 444, 443, 442, 428)
 )
+# the group id in the raw JSON of openQA events, with any spacing or quoting
+OPENQA_GROUP_ID_RE = re.compile(rb'"group_id"\s*:\s*"?(\d+)')
 
 HANGING_REQUESTS = timedelta(hours=12)
 HANGING_REPO_PUBLISH = timedelta(minutes=55)
 HANGING_CONTAINER_TAG = timedelta(days=10)
 OPENQA_FAIL_WAIT = timedelta(minutes=50)
 
+# seconds, unless listen_url sets them
+AMQP_HEARTBEAT = 30
+AMQP_BLOCKED_CONNECTION_TIMEOUT = 30
+# reconnect delays in seconds, the backoff starts over once a connection
+# lasted for RECONNECT_RESET_AFTER
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+RECONNECT_RESET_AFTER = 300.0
+# seconds between the sweeps for hanging requests, publishes and jobs
+CHECK_INTERVAL = 120.0
+
+STATE_FILE = Path(__file__).resolve().parent / 'state.pickle'
+STATE_VERSION = 3
+STATE_ATTRIBUTES = (
+    'openqa_jobs',
+    'bs_requests',
+    'repo_publishes',
+    'container_publishes',
+)
+
+# deliveries the broker may have in flight before they get acknowledged,
+# acks go out per batch and every ACK_BATCH_DELAY seconds. The batch stays
+# well below the prefetch window so the broker never stalls waiting for acks
+PREFETCH_COUNT = 256
+ACK_BATCH_SIZE = PREFETCH_COUNT // 4
+ACK_BATCH_DELAY = 0.5
+
+# keep the connection to the webhook alive between notifications
+_SLACK_SESSION = requests.Session()
+_SLACK_SESSION.headers.update({'Content-Type': 'application/json'})
+_SLACK_SESSION.mount(
+    'https://',
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        # the webhook POST isn't idempotent: never retry once Slack may have
+        # acted on it, only on connect errors and rejecting 429/503 responses
+        max_retries=Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.2,
+            status_forcelist=(429, 503),
+            allowed_methods=None,
+        ),
+    ),
+)
+atexit.register(_SLACK_SESSION.close)
+# a single worker thread does the posting, so a slow webhook doesn't stall
+# the ioloop. The queue is bounded, a Slack outage must not pile up forever
+_SLACK_QUEUE: queue.Queue[dict | None] = queue.Queue(maxsize=1024)
+# seconds the exit waits for the queued posts, well below a service
+# manager's stop timeout
+SLACK_STOP_TIMEOUT = 15.0
+# set on SIGINT/SIGTERM, the ioloop timer and the reconnect backoff watch it
+_SHUTDOWN = threading.Event()
+
+
+def cache_config() -> None:
+    """Cache the settings used on hot paths from CONF in module globals."""
+    global SLACK_URL, OBS_HOST, OPENQA_HOST
+    global OBS_BUILD_LOG_URL, OBS_REQUEST_URL, OBS_PROJECT_REQUESTS_URL
+    global OBS_REPO_STATE_URL, OPENQA_OVERVIEW_URL, PROJECT_RE, REPO_RE
+    SLACK_URL = CONF['DEFAULT'].get('slack_trigger_url')
+    OBS_HOST = CONF['obs']['host']
+    OPENQA_HOST = CONF['openqa']['host']
+    PROJECT_RE = re.compile(CONF['obs']['project_re'], re.ASCII)
+    REPO_RE = re.compile(CONF['obs']['repo_re'], re.ASCII)
+
+    # str.format() templates for the links in the notifications
+    obs = OBS_HOST.rstrip('/')
+    OBS_BUILD_LOG_URL = obs + '/package/live_build_log/{prj}/{pkg}/{repo}/{arch}'
+    OBS_REQUEST_URL = obs + '/request/show/{id}'
+    OBS_PROJECT_REQUESTS_URL = obs + '/project/requests/{prj}'
+    OBS_REPO_STATE_URL = obs + '/project/repository_state/{prj}/{repo}'
+    OPENQA_OVERVIEW_URL = (
+        OPENQA_HOST.rstrip('/') + '/tests/overview?build={build}&groupid={group}'
+    )
+
 
 def post_failure_notification_to_slack(status, body, link_to_failure) -> None:
-    """Post a message to slack with the given parameters by using a webhook."""
+    """Queue a message to slack with the given parameters for the webhook."""
     LOG.debug(
-        f'post_failure_notification_to_slack({status}, {body}, {link_to_failure})'
+        'post_failure_notification_to_slack(%s, %s, %s)', status, body, link_to_failure
     )
 
-    if not CONF['DEFAULT'].get('slack_trigger_url'):
+    if not SLACK_URL:
         LOG.debug('Slack notifications are disabled')
         return
 
-    resp = requests.post(
-        url=CONF['DEFAULT']['slack_trigger_url'],
-        headers={'Content-Type': 'application/json'},
-        json={'status': status, 'body': body, 'link_to_failure': link_to_failure},
-    )
     try:
+        _SLACK_QUEUE.put_nowait(
+            {'status': status, 'body': body, 'link_to_failure': link_to_failure}
+        )
+    except queue.Full:
+        LOG.error('Slack notification queue is full, dropped: %s', body)
+
+
+def start_slack_worker() -> None:
+    """Start the thread posting the queued notifications, drained on exit."""
+    worker = threading.Thread(target=_slack_worker, name='slack', daemon=True)
+    worker.start()
+
+    def stop_slack_worker() -> None:
+        try:
+            _SLACK_QUEUE.put_nowait(None)
+        except queue.Full:
+            # Slack is not keeping up, drop the backlog rather than the shutdown
+            dropped = 0
+            while True:
+                try:
+                    _SLACK_QUEUE.get_nowait()
+                except queue.Empty:
+                    break
+                dropped += 1
+            LOG.warning('Dropped %d queued Slack notifications on exit', dropped)
+            _SLACK_QUEUE.put_nowait(None)
+        worker.join(timeout=SLACK_STOP_TIMEOUT)
+
+    atexit.register(stop_slack_worker)
+
+
+def _slack_worker() -> None:
+    while (payload := _SLACK_QUEUE.get()) is not None:
+        _post_to_slack(payload)
+
+
+def _post_to_slack(payload: dict) -> None:
+    """Send a notification to the webhook, runs on the slack worker thread."""
+    try:
+        resp = _SLACK_SESSION.post(
+            url=SLACK_URL, data=_json_dumps(payload), timeout=(3.05, 10)
+        )
         resp.raise_for_status()
-    except requests.HTTPError as err:
-        LOG.error(f'Failed to post failure notification to slack: {err}')
+    except requests.RequestException as err:
+        LOG.error('Failed to post failure notification to slack: %s', err)
 
 
-@dataclass
+@dataclass(slots=True)
 class openQAJob:
     """Track the state of a openQA job identified by id"""
 
@@ -90,7 +220,27 @@ class openQAJob:
     finished_at: datetime | None = None
 
 
-@dataclass
+@dataclass(slots=True)
+class openQABuild:
+    """Track the openQA jobs of a build and tally their results"""
+
+    jobs: dict[str, openQAJob] = field(default_factory=dict)
+    results: collections.Counter[str] = field(default_factory=collections.Counter)
+
+    def add_job(self, job: openQAJob) -> None:
+        old_job = self.jobs.get(job.test_id)
+        if old_job is not None:
+            self.results[old_job.result] -= 1
+        self.jobs[job.test_id] = job
+        self.results[job.result] += 1
+
+    def set_result(self, job: openQAJob, result: str) -> None:
+        self.results[job.result] -= 1
+        self.results[result] += 1
+        job.result = result
+
+
+@dataclass(slots=True)
 class bs_Request:
     """Track build service requests identified by id"""
 
@@ -98,11 +248,12 @@ class bs_Request:
     targetproject: str
     targetpackage: str
     created_at: datetime
+    state: str = 'new'
     is_announced: bool = False
     is_create_announced: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class repo_publish:
     """Track repository publishing"""
 
@@ -114,17 +265,31 @@ class repo_publish:
 
 
 class Slacky:
-    # when adding more state, please update load_state()
-    openqa_jobs: collections.defaultdict[tuple[int, str], list[openQAJob]] = (
-        collections.defaultdict(list)
+    # when adding more state, please update STATE_ATTRIBUTES and load_state()
+    openqa_jobs: collections.defaultdict[tuple[int, str], openQABuild] = (
+        collections.defaultdict(openQABuild)
     )
     bs_requests: collections.defaultdict[int, bs_Request] = collections.defaultdict(
         None
     )
     repo_publishes: dict = {}
     container_publishes: dict = {}
-    last_interval_check: datetime = datetime.now()
+    next_interval_check: float = 0.0
     do_save_state: bool = False
+    # AMQP session, reset by run() for every connection
+    _channel = None
+    _unacked: int = 0
+    _last_delivery_tag: int = 0
+
+    def __init__(self) -> None:
+        # handlers by routing key namespace, the first three segments
+        self._dispatch = {
+            'suse.openqa.job': self.handle_openqa_event,
+            'suse.obs.package': self.handle_obs_package_event,
+            'suse.obs.request': self.handle_obs_request_event,
+            'suse.obs.repo': self.handle_obs_repo_event,
+            'suse.obs.container': self.handle_container_event,
+        }
 
     def handle_openqa_event(self, routing_key: str, msg) -> None:
         """Find failed jobs without pending jobs and then post a message to slack."""
@@ -135,62 +300,73 @@ class Slacky:
         qajob: tuple[int, str] = (msg['group_id'], build_id)
         test_id: str = f'{msg.get("TEST")}/{msg.get("ARCH")}'
 
-        def find_test_id(job):
-            return job.test_id == test_id
-
-        LOG.debug(f' [x] {routing_key!r}:{msg!r}')
-        if 'suse.openqa.job.create' in routing_key:
-            self.openqa_jobs[qajob].append(
+        LOG.debug(' [x] %r:%r', routing_key, msg)
+        action = routing_key.rpartition('.')[2]
+        if action == 'create':
+            self.openqa_jobs[qajob].add_job(
                 openQAJob(test_id=test_id, build=build_id, result='pending')
             )
-            LOG.info(f'Job {qajob}/{test_id} created (pending)')
-        if 'suse.openqa.job.restart' in routing_key:
-            for job in filter(find_test_id, self.openqa_jobs[qajob]):
-                job.result = 'pending'
-                job.finished_at = None
-                LOG.info(f'Job {qajob}/{test_id} restarted and stored as (pending)')
-                break
-            else:
-                LOG.info(f'Ignored restart on {qajob}/{test_id}')
-        elif 'suse.openqa.job.done' in routing_key:
-            for job in filter(find_test_id, self.openqa_jobs[qajob]):
-                if msg.get('reason') is not None:
-                    LOG.info(f'Job {qajob}/{test_id} is going to restart')
-                    continue
-                job.result = msg['result']
-                job.finished_at = datetime.now()
+            LOG.info('Job %s/%s created (pending)', qajob, test_id)
+            self.do_save_state = True
+            return
+
+        # don't let events for untracked builds create empty entries
+        build = self.openqa_jobs.get(qajob)
+        job = build.jobs.get(test_id) if build is not None else None
+        if action == 'restart':
+            if job is None:
+                LOG.info('Ignored restart on %s/%s', qajob, test_id)
+                return
+            build.set_result(job, 'pending')
+            job.finished_at = None
+            LOG.info('Job %s/%s restarted and stored as (pending)', qajob, test_id)
+            self.do_save_state = True
+        elif action == 'done' and job is not None:
+            if msg.get('reason') is not None:
+                LOG.info('Job %s/%s is going to restart', qajob, test_id)
+                return
+            build.set_result(job, msg['result'])
+            job.finished_at = datetime.now()
+            self.do_save_state = True
 
     def handle_obs_package_event(self, routing_key, msg):
         """Post any build failures for the configured projects to slack."""
         if (
-            not self.project_re.match(msg.get('project', ''))
+            self.project_re.match(msg.get('project') or '') is None
             or msg.get('previouslyfailed') == '1'
         ):
             return
 
-        if 'suse.obs.package.build_fail' in routing_key:
+        if routing_key == 'suse.obs.package.build_fail':
             LOG.info(
-                f'obs build fail {msg["project"]}/{msg["package"]}/{msg["repository"]}/{msg["arch"]}'
+                'obs build fail %s/%s/%s/%s',
+                msg['project'],
+                msg['package'],
+                msg['repository'],
+                msg['arch'],
             )
             post_failure_notification_to_slack(
                 ':obs:',
                 f'{msg["project"]}/{msg["package"]}/{msg["repository"]}/{msg["arch"]} failed to build.',
-                urllib.parse.urljoin(
-                    CONF['obs']['host'],
-                    f'/package/live_build_log/{msg["project"]}/{msg["package"]}/{msg["repository"]}/{msg["arch"]}',
+                OBS_BUILD_LOG_URL.format(
+                    prj=msg['project'],
+                    pkg=msg['package'],
+                    repo=msg['repository'],
+                    arch=msg['arch'],
                 ),
             )
 
     def handle_obs_repo_event(self, routing_key, msg):
         """Post any build failures for the configured projects to slack."""
-        if not self.repo_re.match(msg.get('project')) or not msg.get('state'):
+        if self.repo_re.match(msg.get('project') or '') is None or not msg.get('state'):
             return
 
         prjrepo = f'{msg["project"]}/{msg["repo"]}'
-        LOG.info(f'repo event for {prjrepo}: {msg}')
+        LOG.info('repo event for %s: %s', prjrepo, msg)
         if msg['state'] == 'published':
             if prjrepo in self.repo_publishes:
                 del self.repo_publishes[prjrepo]
+                self.do_save_state = True
             return
 
         self.repo_publishes[prjrepo] = repo_publish(
@@ -199,14 +375,17 @@ class Slacky:
             state=msg['state'],
             state_changed=datetime.now(),
         )
+        self.do_save_state = True
 
     def handle_obs_request_event(self, routing_key, msg):
         """Warn when requests get declined, track them for hang detection."""
-        if 'suse.obs.request.create' in routing_key:
+        if routing_key == 'suse.obs.request.create':
             for action in msg['actions']:
                 if action['type'] == 'submit' and 'BCI' in action['targetproject']:
                     LOG.info(
-                        f'found new submitrequest against {action["targetproject"]}: id {msg["number"]}'
+                        'found new submitrequest against %s: id %s',
+                        action['targetproject'],
+                        msg['number'],
                     )
                     bs_request = bs_Request(
                         id=msg['number'],
@@ -215,31 +394,34 @@ class Slacky:
                         created_at=datetime.now(),
                     )
                     self.bs_requests[msg['number']] = bs_request
+                    self.do_save_state = True
 
-        if 'suse.obs.request.state_change' in routing_key:
+        elif routing_key == 'suse.obs.request.state_change':
             bs_request = self.bs_requests.get(msg['number'])
             if bs_request:
                 bs_request.state = msg['state']
+                self.do_save_state = True
                 if msg['state'] in ('declined',):
                     post_failure_notification_to_slack(
                         ':request-changes:',
                         f'Request to {bs_request.targetproject} / {bs_request.targetpackage} got declined.',
-                        urllib.parse.urljoin(
-                            CONF['obs']['host'], f'/request/show/{bs_request.id}'
-                        ),
+                        OBS_REQUEST_URL.format(id=bs_request.id),
                     )
                     bs_request.is_announced = True
                     bs_request.is_create_announced = True
                 if msg['state'] in ('accepted', 'revoked', 'superseded'):
-                    LOG.info(f'request {msg["number"]} entered final state.')
+                    LOG.info('request %s entered final state.', msg['number'])
                     del self.bs_requests[msg['number']]
 
     def handle_container_event(self, routing_key: str, msg):
         """Warn when a floating tag didn't get published for a long time."""
-        if 'suse.obs.container.published' not in routing_key:
+        if routing_key != 'suse.obs.container.published':
             return
 
-        if not msg.get('container') or not self.repo_re.match(msg.get('project', '')):
+        if (
+            not msg.get('container')
+            or self.repo_re.match(msg.get('project') or '') is None
+        ):
             return
 
         repository, _, tag = msg['container'].partition(':')
@@ -251,71 +433,70 @@ class Slacky:
             return
 
         repo_tag: str = f'{repository.partition("/")[2]}:{tag_version}'
-        LOG.info(f'Container {repo_tag} published.')
+        LOG.info('Container %s published.', repo_tag)
         self.container_publishes[repo_tag] = datetime.now()
         self.do_save_state = True
 
-    def check_pending_requests(self) -> None:
+    def check_pending_requests(self, now: datetime | None = None) -> None:
         """Announce for things that are hanging around"""
+        if now is None:
+            now = datetime.now()
 
-        # Announce request that are open for a long time
-        for prj, reqcount in collections.Counter(
-            (
-                req.targetproject
-                for req in self.bs_requests.values()
-                if (
-                    not req.is_announced
-                    and (req.created_at + HANGING_REQUESTS) < datetime.now()
+        # Group the requests that still need an announcement by project
+        unannounced: collections.defaultdict[str, list[bs_Request]] = (
+            collections.defaultdict(list)
+        )
+        uncreated: collections.defaultdict[str, list[bs_Request]] = (
+            collections.defaultdict(list)
+        )
+        hanging: collections.Counter[str] = collections.Counter()
+        newest_request_age: dict[str, timedelta] = {}
+        for req in self.bs_requests.values():
+            age = now - req.created_at
+            if not req.is_announced:
+                unannounced[req.targetproject].append(req)
+                if age > HANGING_REQUESTS:
+                    hanging[req.targetproject] += 1
+            if not req.is_create_announced:
+                uncreated[req.targetproject].append(req)
+                newest_request_age[req.targetproject] = min(
+                    newest_request_age.get(req.targetproject, HANGING_REQUESTS), age
                 )
-            )
-        ).most_common():
+
+        # Announce request that are open for a long time
+        for prj, reqcount in hanging.most_common():
             pkgs = set()
-            for req in self.bs_requests.values():
-                if req.targetproject == prj and not req.is_announced:
-                    pkgs.add(req.targetpackage)
-                    req.is_announced = True
-                    req.is_create_announced = True
+            for req in unannounced[prj]:
+                pkgs.add(req.targetpackage)
+                req.is_announced = True
+                req.is_create_announced = True
+            uncreated.pop(prj, None)
             post_failure_notification_to_slack(
                 ':request-changes:',
                 f'{reqcount} hanging requests to {prj} / {", ".join(sorted(pkgs))} '
                 if reqcount > 1
                 else f'Request to {prj} / {", ".join(pkgs)} is still open ',
-                urllib.parse.urljoin(CONF['obs']['host'], f'/project/requests/{prj}'),
+                OBS_PROJECT_REQUESTS_URL.format(prj=prj),
             )
             self.do_save_state = True
 
         # Announce requests that have been recently created
-        for prj, reqcount in collections.Counter(
-            (
-                req.targetproject
-                for req in self.bs_requests.values()
-                if not req.is_create_announced
-            )
-        ).most_common():
-            newest_request_age: float = HANGING_REQUESTS.total_seconds()
-            for req in self.bs_requests.values():
-                if req.targetproject == prj and not req.is_create_announced:
-                    if (
-                        datetime.now() - req.created_at
-                    ).total_seconds() < newest_request_age:
-                        newest_request_age = (
-                            datetime.now() - req.created_at
-                        ).total_seconds()
+        for prj, reqs in sorted(
+            uncreated.items(), key=lambda item: len(item[1]), reverse=True
+        ):
             # If we haven't seen a new request in a while, time to announce
-            if 60 < newest_request_age < HANGING_REQUESTS.total_seconds():
+            if timedelta(seconds=60) < newest_request_age[prj] < HANGING_REQUESTS:
+                reqcount = len(reqs)
                 pkgs = set()
-                for req in self.bs_requests.values():
-                    if req.targetproject == prj and not req.is_create_announced:
-                        pkgs.add(req.targetpackage)
-                        req.is_create_announced = True
+                for req in reqs:
+                    pkgs.add(req.targetpackage)
+                    req.is_create_announced = True
                 post_failure_notification_to_slack(
                     ':announcement:',
                     f'{reqcount} open requests to {prj} / {", ".join(sorted(pkgs))} for review. '
                     if reqcount > 1
                     else f'New request to {prj} / {", ".join(pkgs)} available for review. ',
-                    urllib.parse.urljoin(
-                        CONF['obs']['host'], f'/project/requests/{prj}'
-                    ),
+                    OBS_PROJECT_REQUESTS_URL.format(prj=prj),
                 )
                 self.do_save_state = True
 
@@ -323,72 +504,65 @@ class Slacky:
         for repo in self.repo_publishes.values():
             if (
                 not repo.is_announced
-                and (repo.state_changed + HANGING_REPO_PUBLISH) < datetime.now()
+                and (repo.state_changed + HANGING_REPO_PUBLISH) < now
             ):
                 post_failure_notification_to_slack(
                     ':published:',
                     f'{repo.project} / {repo.repository} is not published after {HANGING_REPO_PUBLISH}',
-                    urllib.parse.urljoin(
-                        CONF['obs']['host'],
-                        f'/project/repository_state/{repo.project}/{repo.repository}',
-                    ),
+                    OBS_REPO_STATE_URL.format(prj=repo.project, repo=repo.repository),
                 )
                 repo.is_announced = True
                 self.do_save_state = True
 
         # Announce container tags that have not been published for a while
-        hanging_containers = sorted(
-            [
-                c
-                for c, publishdate in self.container_publishes.items()
-                if (
-                    (publishdate + HANGING_CONTAINER_TAG) < datetime.now()
-                    and (publishdate + HANGING_CONTAINER_TAG + timedelta(hours=2))
-                    > datetime.now()
-                )
-            ]
-        )
+        hanging_since = now - HANGING_CONTAINER_TAG
+        hanging_containers = []
+        kept_containers = {}
+        for container, publishdate in self.container_publishes.items():
+            if hanging_since - timedelta(hours=2) < publishdate < hanging_since:
+                hanging_containers.append(container)
+            else:
+                kept_containers[container] = publishdate
         if hanging_containers:
+            hanging_containers.sort()
             post_failure_notification_to_slack(
                 ':question:',
                 f'These tags were not published after {HANGING_CONTAINER_TAG}: {",".join(hanging_containers)}',
                 'https://registry.suse.com/',
             )
-            for container in hanging_containers:
-                self.container_publishes.pop(container)
+            self.container_publishes = kept_containers
             self.do_save_state = True
 
         # Announce any openqa runs that have failures even after a while
         builds_to_delete = []
-        for (group_id, build_id), build_results in self.openqa_jobs.items():
-            results = collections.Counter(j.result for j in build_results)
-            result_times = sorted(
-                [
+        for (group_id, build_id), build in self.openqa_jobs.items():
+            pending = build.results['pending']
+            failed = build.results['failed']
+            last_finished = max(
+                (
                     j.finished_at
-                    for j in filter(lambda x: x.finished_at is not None, build_results)
-                ],
-                reverse=True,
+                    for j in build.jobs.values()
+                    if j.finished_at is not None
+                ),
+                default=None,
             )
-            if (
-                len(result_times)
-                and result_times[0]
-                and (result_times[0] + OPENQA_FAIL_WAIT) < datetime.now()
-            ):
-                LOG.info(f'Job {build_id} ended - results: {results}')
-                if not results.get('pending') and results.get('failed'):
-                    body: str = (
-                        f'Build {build_id} has {results["failed"]} failed tests.'
-                    )
+            if last_finished and (last_finished + OPENQA_FAIL_WAIT) < now:
+                LOG.info(
+                    'Job %s ended - results: %d jobs, %d pending, %d failed',
+                    build_id,
+                    len(build.jobs),
+                    pending,
+                    failed,
+                )
+                if not pending and failed:
+                    body: str = f'Build {build_id} has {failed} failed tests.'
                     post_failure_notification_to_slack(
                         ':openqa:',
                         body,
-                        urllib.parse.urljoin(
-                            CONF['openqa']['host'],
-                            f'/tests/overview?build={build_id}&groupid={group_id}',
-                        ),
+                        OPENQA_OVERVIEW_URL.format(build=build_id, group=group_id),
                     )
                     self.do_save_state = True
-                if not results.get('pending'):
+                if not pending:
                     builds_to_delete.append((group_id, build_id))
         for group_id, build_id in builds_to_delete:
             del self.openqa_jobs[(group_id, build_id)]
@@ -399,77 +573,191 @@ class Slacky:
 
     def load_state(self) -> None:
         """Restore persisted from a previously launched slacky"""
-        state_file = Path(__file__).resolve().parent / 'state.pickle'
-        if state_file.is_file():
-            with open(Path(__file__).resolve().parent / 'state.pickle', 'rb') as f:
+        if not STATE_FILE.is_file():
+            return
+        # states before STATE_VERSION 2 hold dataclasses without __slots__,
+        # those can't be restored into the current ones. Older slackys also
+        # didn't write the file atomically, so it may be truncated
+        try:
+            with open(STATE_FILE, 'rb') as f:
                 data = pickle.load(f)
-                # copy over the state from a previous launched slacky
-                self.openqa_jobs = data.openqa_jobs
-                LOG.info(f'Loaded state(openqa_jobs = {self.openqa_jobs})')
-                self.bs_requests = data.bs_requests
-                LOG.info(f'Loaded state(bs_requests = {self.bs_requests})')
-                self.repo_publishes = data.repo_publishes
-                LOG.info(f'Loaded state(repo_publish = {self.repo_publishes})')
-                self.container_publishes = data.container_publishes
-                LOG.info(
-                    f'Loaded state(container_publishes = {self.container_publishes})'
-                )
+        except (
+            AttributeError,
+            EOFError,
+            ImportError,
+            TypeError,
+            pickle.UnpicklingError,
+        ):
+            data = None
+        if not isinstance(data, dict) or data.get('version') != STATE_VERSION:
+            LOG.warning(
+                'Ignoring %s, unreadable or from an older slacky version',
+                STATE_FILE.name,
+            )
+            return
+
+        # copy over the state from a previous launched slacky
+        self.openqa_jobs = data['openqa_jobs']
+        LOG.info('Loaded state(openqa_jobs = %s)', self.openqa_jobs)
+        self.bs_requests = data['bs_requests']
+        LOG.info('Loaded state(bs_requests = %s)', self.bs_requests)
+        self.repo_publishes = data['repo_publishes']
+        LOG.info('Loaded state(repo_publish = %s)', self.repo_publishes)
+        self.container_publishes = data['container_publishes']
+        LOG.info('Loaded state(container_publishes = %s)', self.container_publishes)
 
     def save_state(self) -> None:
         """pickle the slacky state for future instance preservation"""
-        with open(Path(__file__).resolve().parent / 'state.pickle', 'wb') as f:
-            pickle.dump(self, f)
-            LOG.info('Saved state to state.pickle')
+        state = {attr: getattr(self, attr) for attr in STATE_ATTRIBUTES}
+        state['version'] = STATE_VERSION
+        # replace the state atomically, a crash must not leave a truncated file
+        tmp_file = STATE_FILE.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, STATE_FILE)
+        LOG.info('Saved state to state.pickle')
 
     def run(self) -> None:
         """pubsub subscribe to events posted on the AMPQ channel."""
-        channel: BlockingChannel = pika.BlockingConnection(
-            pika.URLParameters(CONF['DEFAULT']['listen_url'])
-        ).channel()
+        self.load_state()
+        self.next_interval_check = time.monotonic() + CHECK_INTERVAL
+        # compiled once by cache_config(), not again on every reconnect
+        self.project_re = PROJECT_RE
+        self.repo_re = REPO_RE
+        self._channel = None
+        self._queue_name = ''
+        self._closed_reason = None
+        self._unacked = 0
+        self._last_delivery_tag = 0
+        params = pika.URLParameters(CONF['DEFAULT']['listen_url'])
+        if params.heartbeat is None:
+            params.heartbeat = AMQP_HEARTBEAT
+        if params.blocked_connection_timeout is None:
+            params.blocked_connection_timeout = AMQP_BLOCKED_CONNECTION_TIMEOUT
+        self._connection = pika.SelectConnection(
+            params,
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_closed,
+            on_close_callback=self.on_connection_closed,
+        )
+        self._connection.ioloop.call_later(ACK_BATCH_DELAY, self.on_timer)
+        self._connection.ioloop.start()
+        if _SHUTDOWN.is_set():
+            self.save_state()
+            LOG.info('State saved!')
+            return
+        # let main() reconnect
+        raise self._closed_reason
+
+    def dispatch(self, routing_key: str, body: bytes) -> None:
+        """Generic dispatcher for events posted on the AMPQ channel."""
+
+        # dispatch on the namespace, the first three routing key segments
+        namespace = '.'.join(routing_key.split('.', 3)[:3])
+        handler = self._dispatch.get(namespace)
+        if handler is None:
+            return
+        # most openQA events are for other groups, don't bother decoding them.
+        # Bodies without a recognizable group id are decoded anyway
+        if namespace == 'suse.openqa.job':
+            group_id = OPENQA_GROUP_ID_RE.search(body)
+            if group_id is not None and int(group_id[1]) not in OPENQA_GROUPS_FILTER:
+                return
+        # of the package events only build failures get announced
+        if (
+            namespace == 'suse.obs.package'
+            and routing_key != 'suse.obs.package.build_fail'
+        ):
+            return
+
+        try:
+            msg = _json_loads(body)
+        except json.JSONDecodeError:
+            return
+
+        handler(routing_key, msg)
+
+    def on_message(self, _channel: Channel, method, _properties, body: bytes) -> None:
+        self.dispatch(method.routing_key, body)
+
+        self._unacked += 1
+        self._last_delivery_tag = method.delivery_tag
+        if self._unacked >= ACK_BATCH_SIZE:
+            self.flush_acks()
+
+    def flush_acks(self) -> None:
+        if self._unacked and self._channel is not None and self._channel.is_open:
+            self._channel.basic_ack(delivery_tag=self._last_delivery_tag, multiple=True)
+        self._unacked = 0
+
+    def on_timer(self) -> None:
+        if _SHUTDOWN.is_set():
+            self.flush_acks()
+            if self._connection.is_open:
+                self._connection.close()
+            elif not self._connection.is_closing:
+                # still connecting, pika can't abort that cleanly
+                self._connection.ioloop.stop()
+            return
+        # acknowledge the tail of a burst too, not only full batches
+        self.flush_acks()
+        # sweep from the timer, reminders are due even when the bus is quiet
+        tick = time.monotonic()
+        if tick >= self.next_interval_check:
+            self.check_pending_requests()
+            self.next_interval_check = tick + CHECK_INTERVAL
+        self._connection.ioloop.call_later(ACK_BATCH_DELAY, self.on_timer)
+
+    # the setup runs as a chain of callbacks on the connection's ioloop
+    def on_connection_open(self, connection: pika.SelectConnection) -> None:
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel: Channel) -> None:
+        self._channel = channel
+        channel.add_on_close_callback(self.on_channel_closed)
         channel.exchange_declare(
-            exchange='pubsub', exchange_type='topic', passive=True, durable=False
+            exchange='pubsub',
+            exchange_type='topic',
+            passive=True,
+            durable=False,
+            callback=self.on_exchange_declared,
         )
-        queue_name = channel.queue_declare('', exclusive=True).method.queue
-        channel.queue_bind(exchange='pubsub', queue=queue_name, routing_key='#')
 
-        self.load_state()
-        self.project_re = re.compile(CONF['obs']['project_re'])
-        self.repo_re = re.compile(CONF['obs']['repo_re'])
+    def on_exchange_declared(self, _frame) -> None:
+        self._channel.queue_declare('', exclusive=True, callback=self.on_queue_declared)
 
-        def callback(_, method, _unused, body) -> None:
-            """Generic dispatcher for events posted on the AMPQ channel."""
+    def on_queue_declared(self, frame) -> None:
+        self._queue_name = frame.method.queue
+        # only have the namespaces delivered that there is a handler for
+        routing_keys = [f'{namespace}.#' for namespace in self._dispatch]
+        for routing_key in routing_keys[:-1]:
+            self._channel.queue_bind(
+                self._queue_name, 'pubsub', routing_key=routing_key
+            )
+        # the broker handles a channel's methods in order, so this bind
+        # is confirmed after all the nowait ones above
+        self._channel.queue_bind(
+            self._queue_name,
+            'pubsub',
+            routing_key=routing_keys[-1],
+            callback=self.on_queue_bound,
+        )
 
-            if (datetime.now() - self.last_interval_check).total_seconds() > 120:
-                self.check_pending_requests()
-                self.last_interval_check = datetime.now()
+    def on_queue_bound(self, _frame) -> None:
+        self._channel.basic_qos(prefetch_count=PREFETCH_COUNT, callback=self.on_qos_set)
 
-            routing_key = method.routing_key
-            msg = {}
-            try:
-                msg = json.loads(body)
-            except json.decoder.JSONDecodeError:
-                return
+    def on_qos_set(self, _frame) -> None:
+        self._channel.basic_consume(self._queue_name, self.on_message, auto_ack=False)
+        print(' [*] Waiting for events. To exit press CTRL+C')
 
-            if routing_key.startswith('suse.openqa'):
-                self.handle_openqa_event(routing_key, msg)
-            elif routing_key.startswith('suse.obs.package'):
-                self.handle_obs_package_event(routing_key, msg)
-            elif routing_key.startswith('suse.obs.request'):
-                self.handle_obs_request_event(routing_key, msg)
-            elif routing_key.startswith('suse.obs.repo'):
-                self.handle_obs_repo_event(routing_key, msg)
-            elif routing_key.startswith('suse.obs.container'):
-                self.handle_container_event(routing_key, msg)
-
-        channel.basic_consume(queue_name, callback, auto_ack=True)
-        try:
-            print(' [*] Waiting for events. To exit press CTRL+C')
-            channel.start_consuming()
-        except (KeyboardInterrupt, ConnectionResetError):
-            channel.stop_consuming()
-            self.save_state()
-            LOG.info('State saved!')
-            sys.exit(0)
+    def on_channel_closed(self, _channel: Channel, _reason: Exception) -> None:
+        # without a channel there is nothing to consume, start over
+        if self._connection.is_open:
+            self._connection.close()
+
+    def on_connection_closed(self, _connection, reason: Exception) -> None:
+        self._closed_reason = reason
+        self._connection.ioloop.stop()
 
 
 def main() -> None:
@@ -488,17 +776,31 @@ def main() -> None:
 
     with open(os.path.expanduser('~/.config/slacky'), encoding='utf8') as f:
         CONF.read_file(f)
+    cache_config()
+    start_slack_worker()
 
-    def handle_sigterm(sig, frame):
-        raise KeyboardInterrupt
+    def handle_shutdown(sig, frame):
+        _SHUTDOWN.set()
 
-    signal.signal(signalnum=signal.SIGTERM, handler=handle_sigterm)
-    while True:
+    signal.signal(signalnum=signal.SIGINT, handler=handle_shutdown)
+    signal.signal(signalnum=signal.SIGTERM, handler=handle_shutdown)
+    delay = RECONNECT_BASE_DELAY
+    while not _SHUTDOWN.is_set():
         slacky = Slacky()
+        started = time.monotonic()
         try:
             slacky.run()
-        except (pika.exceptions.ConnectionClosed, pika.exceptions.AMQPHeartbeatTimeout):
-            time.sleep(random.randint(10, 100))
+        except pika.exceptions.AMQPConnectionError as err:
+            # keep what was tracked so far, the next instance loads it again
+            slacky.save_state()
+            if time.monotonic() - started > RECONNECT_RESET_AFTER:
+                delay = RECONNECT_BASE_DELAY
+            # exponential backoff with decorrelated jitter
+            delay = min(
+                RECONNECT_MAX_DELAY, random.uniform(RECONNECT_BASE_DELAY, delay * 3)
+            )
+            LOG.info('Connection lost (%r), reconnecting in %.1fs', err, delay)
+            _SHUTDOWN.wait(delay)
 
 
 if __name__ == '__main__':
@@ -16,168 +16,249 @@ SPDX-License-Identifier: GPL-2.0-or-later
 """
 
 import collections
+import contextlib
 import datetime
 import json
-import re
-from unittest.mock import patch
+import pickle
+from types import MappingProxyType, SimpleNamespace
 
-import slacky
-
-testing_CONF = {}
-testing_CONF['DEFAULT'] = {}
-testing_CONF['obs'] = {'host': 'https://localhost/'}
-testing_CONF['openqa'] = {'host': 'https://localhost/'}
+import pytest
 
+import slacky
 
-@patch('slacky.post_failure_notification_to_slack', return_value=None)
-def test_pending_bs_requests_grouping(mock_post_failure_notification):
-    bot = slacky.Slacky()
-    slacky.CONF = testing_CONF
-
-    bot.bs_requests = {
-        1: slacky.bs_Request(
-            id=1,
-            targetproject='project1',
-            targetpackage='package1',
-            created_at=datetime.datetime(2023, 1, 2),
-        ),
-        2: slacky.bs_Request(
-            id=2,
-            targetproject='project1',
-            targetpackage='package2',
-            created_at=datetime.datetime(2023, 1, 3),
+# read-only, so no test can leak config changes into the others
+testing_CONF = MappingProxyType(
+    {
+        'DEFAULT': MappingProxyType({}),
+        'obs': MappingProxyType(
+            {
+                'host': 'https://localhost/',
+                'project_re': r'^SUSE:SLE-15-SP6:Update:BCI',
+                'repo_re': r'^SUSE:Containers:SLE-SERVER:',
+            }
         ),
+        'openqa': MappingProxyType({'host': 'https://localhost/'}),
     }
-
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
-    bot.check_pending_requests()
-    mock_post_failure_notification.assert_called_once_with(
-        ':request-changes:',
-        '2 hanging requests to project1 / package1, package2 ',
-        'https://localhost/project/requests/project1',
+)
+
+_DAY1 = datetime.datetime(2023, 1, 1)
+_DAY2 = datetime.datetime(2023, 1, 2)
+_DAY3 = datetime.datetime(2023, 1, 3)
+
+# notifications expected by more than one test
+_PROJECT1_REQUESTS = 'https://localhost/project/requests/project1'
+_PACKAGE1_STILL_OPEN = (
+    ':request-changes:',
+    'Request to project1 / package1 is still open ',
+    _PROJECT1_REQUESTS,
+)
+_PACKAGES_HANGING = (
+    ':request-changes:',
+    '2 hanging requests to project1 / package1, package2 ',
+    _PROJECT1_REQUESTS,
+)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def config():
+    """Install testing_CONF, cache_config() compiles its patterns once per module."""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(slacky, 'CONF', testing_CONF)
+        slacky.cache_config()
+        yield
+
+
+@pytest.fixture(autouse=True)
+def state_file(monkeypatch, tmp_path):
+    # keep the tests from writing state.pickle next to the sources
+    monkeypatch.setattr(slacky, 'STATE_FILE', tmp_path / 'state.pickle')
+
+
+@pytest.fixture
+def bot(config):
+    """A Slacky with its own state instead of the containers shared on the class."""
+    bot = slacky.Slacky()
+    # compiled once from testing_CONF by the config fixture, assigned the
+    # same way Slacky.run() does
+    bot.project_re = slacky.PROJECT_RE
+    bot.repo_re = slacky.REPO_RE
+    bot.openqa_jobs = collections.defaultdict(slacky.openQABuild)
+    bot.bs_requests = {}
+    bot.repo_publishes = {}
+    bot.container_publishes = {}
+    return bot
+
+
+@pytest.fixture
+def notify_recorder(monkeypatch):
+    """Record the notifications as plain argument tuples instead of posting them."""
+    calls = []
+    monkeypatch.setattr(
+        slacky, 'post_failure_notification_to_slack', lambda *args: calls.append(args)
     )
-    for _, req in bot.bs_requests.items():
-        assert req.is_announced
+    return calls
 
 
-@patch('slacky.post_failure_notification_to_slack', return_value=None)
-def test_pending_bs_requests_single(mock_post_failure_notification):
-    bot = slacky.Slacky()
-    slacky.CONF = testing_CONF
-
-    bot.bs_requests = {
-        1: slacky.bs_Request(
-            id=1,
-            targetproject='project1',
-            targetpackage='package1',
-            created_at=datetime.datetime(2023, 1, 2),
+def _bs_requests(*rows) -> dict[int, slacky.bs_Request]:
+    """Build bs_requests from (id, targetproject, targetpackage, created_at) rows."""
+    return {
+        number: slacky.bs_Request(
+            id=number,
+            targetproject=project,
+            targetpackage=package,
+            created_at=created_at,
         )
+        for number, project, package, created_at in rows
     }
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
-    with patch('slacky.datetime') as mock_datetime:
-        mock_datetime.now.return_value = datetime.datetime(
-            2023, 1, 2
-        ) + datetime.timedelta(seconds=90)
-        bot.check_pending_requests()
 
-        mock_post_failure_notification.assert_called_once_with(
-            ':announcement:',
-            'New request to project1 / package1 available for review. ',
-            'https://localhost/project/requests/project1',
-        )
-        mock_post_failure_notification.reset_mock()
-        mock_datetime.now.return_value = datetime.datetime(
-            2023, 1, 2
-        ) + datetime.timedelta(seconds=300)
-        bot.check_pending_requests()
-        mock_post_failure_notification.assert_not_called()
 
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
-    bot.check_pending_requests()
-    mock_post_failure_notification.assert_called_once_with(
-        ':request-changes:',
-        'Request to project1 / package1 is still open ',
-        'https://localhost/project/requests/project1',
-    )
+class _FrozenDatetime:
+    """Stands in for slacky.datetime, of which only now() is used at runtime."""
 
+    frozen: datetime.datetime
 
-@patch('slacky.post_failure_notification_to_slack', return_value=None)
-def test_pending_bs_requests_multiple(mock_post_failure_notification):
-    bot = slacky.Slacky()
-    slacky.CONF = testing_CONF
-
-    bot.bs_requests = {
-        1: slacky.bs_Request(
-            id=1,
-            targetproject='project1',
-            targetpackage='package1',
-            created_at=datetime.datetime(2023, 1, 2),
+    def now(self) -> datetime.datetime:
+        return self.frozen
+
+
+@contextlib.contextmanager
+def frozen_datetime():
+    clock = _FrozenDatetime()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(slacky, 'datetime', clock)
+        yield clock
+
+
+def test_pending_bs_requests_grouping(bot, notify_recorder):
+    bot.bs_requests = _bs_requests(
+        (1, 'project1', 'package1', _DAY2), (2, 'project1', 'package2', _DAY3)
+    )
+
+    bot.check_pending_requests()
+    assert notify_recorder == [_PACKAGES_HANGING]
+    assert all(req.is_announced for req in bot.bs_requests.values())
+
+
+@pytest.mark.parametrize(
+    'packages,announcement,reminder',
+    [
+        (
+            ['package1'],
+            (
+                ':announcement:',
+                'New request to project1 / package1 available for review. ',
+                _PROJECT1_REQUESTS,
+            ),
+            _PACKAGE1_STILL_OPEN,
         ),
-        2: slacky.bs_Request(
-            id=2,
-            targetproject='project1',
-            targetpackage='package2',
-            created_at=datetime.datetime(2023, 1, 2),
+        (
+            ['package1', 'package2'],
+            (
+                ':announcement:',
+                '2 open requests to project1 / package1, package2 for review. ',
+                _PROJECT1_REQUESTS,
+            ),
+            _PACKAGES_HANGING,
         ),
-    }
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
-    with patch('slacky.datetime') as mock_datetime:
-        mock_datetime.now.return_value = datetime.datetime(
-            2023, 1, 2
-        ) + datetime.timedelta(seconds=90)
+    ],
+    ids=['single', 'multiple'],
+)
+def test_pending_bs_requests(bot, notify_recorder, packages, announcement, reminder):
+    bot.bs_requests = _bs_requests(
+        *(
+            (number, 'project1', package, _DAY2)
+            for number, package in enumerate(packages, start=1)
+        )
+    )
+    with frozen_datetime() as clock:
+        clock.frozen = _DAY2 + datetime.timedelta(seconds=90)
         bot.check_pending_requests()
 
-        mock_post_failure_notification.assert_called_once_with(
-            ':announcement:',
-            '2 open requests to project1 / package1, package2 for review. ',
-            'https://localhost/project/requests/project1',
-        )
-        mock_post_failure_notification.reset_mock()
-        mock_datetime.now.return_value = datetime.datetime(
-            2023, 1, 2
-        ) + datetime.timedelta(seconds=300)
+        assert notify_recorder == [announcement]
+        notify_recorder.clear()
+        clock.frozen = _DAY2 + datetime.timedelta(seconds=300)
         bot.check_pending_requests()
-        mock_post_failure_notification.assert_not_called()
+        assert notify_recorder == []
 
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
     bot.check_pending_requests()
-    mock_post_failure_notification.assert_called_once_with(
-        ':request-changes:',
-        '2 hanging requests to project1 / package1, package2 ',
-        'https://localhost/project/requests/project1',
-    )
+    assert notify_recorder == [reminder]
 
 
-@patch('slacky.post_failure_notification_to_slack', return_value=None)
-def test_declined_bs_requests_single(mock_post_failure_notification):
-    bot = slacky.Slacky()
-    slacky.CONF = testing_CONF
+def test_pending_bs_requests_multiple_projects(bot, notify_recorder):
+    bot.bs_requests = _bs_requests(
+        (1, 'project1', 'package1', _DAY1), (2, 'project2', 'package2', _DAY2)
+    )
+    bot.check_pending_requests(_DAY2 + datetime.timedelta(seconds=90))
+    assert notify_recorder == [
+        _PACKAGE1_STILL_OPEN,
+        (
+            ':announcement:',
+            'New request to project2 / package2 available for review. ',
+            'https://localhost/project/requests/project2',
+        ),
+    ]
+    assert bot.bs_requests[1].is_announced
+    assert not bot.bs_requests[2].is_announced
+    assert bot.bs_requests[2].is_create_announced
+
 
-    body = '{"number": 1, "state": "new", "actions": [{"type": "submit", "targetproject": "SUSE:SLE-15-SP6:Update:BCI", "targetpackage": "test"}]}'
-    bot.handle_obs_request_event('suse.obs.request.create', json.loads(body))
+def test_declined_bs_requests_single(bot, notify_recorder):
+    bot.handle_obs_request_event(
+        'suse.obs.request.create',
+        {
+            'number': 1,
+            'state': 'new',
+            'actions': [
+                {
+                    'type': 'submit',
+                    'targetproject': 'SUSE:SLE-15-SP6:Update:BCI',
+                    'targetpackage': 'test',
+                }
+            ],
+        },
+    )
 
-    mock_post_failure_notification.assert_not_called()
+    assert notify_recorder == []
 
-    body = '{"number": 1, "state": "review"}'
-    bot.handle_obs_request_event('suse.obs.request.state_change', json.loads(body))
-    body = '{"number": 1, "state": "declined"}'
-    bot.handle_obs_request_event('suse.obs.request.state_change', json.loads(body))
-    mock_post_failure_notification.assert_called_with(
+    bot.handle_obs_request_event(
+        'suse.obs.request.state_change', {'number': 1, 'state': 'review'}
+    )
+    bot.handle_obs_request_event(
+        'suse.obs.request.state_change', {'number': 1, 'state': 'declined'}
+    )
+    assert notify_recorder[-1] == (
         ':request-changes:',
         'Request to SUSE:SLE-15-SP6:Update:BCI / test got declined.',
         'https://localhost/request/show/1',
     )
 
 
-@patch('slacky.post_failure_notification_to_slack', return_value=None)
-def test_obs_repo_publish(mock_post_failure_notification):
-    bot = slacky.Slacky()
-    bot.repo_re = re.compile(r'^SUSE:Containers:SLE-SERVER:')
+def test_obs_build_fail(bot, notify_recorder):
+    msg = {
+        'project': 'SUSE:SLE-15-SP6:Update:BCI',
+        'package': 'test',
+        'repository': 'images',
+        'arch': 'x86_64',
+    }
+    bot.handle_obs_package_event('suse.obs.package.build_fail', msg)
+    assert notify_recorder == [
+        (
+            ':obs:',
+            'SUSE:SLE-15-SP6:Update:BCI/test/images/x86_64 failed to build.',
+            'https://localhost/package/live_build_log/SUSE:SLE-15-SP6:Update:BCI/test/images/x86_64',
+        )
+    ]
+
+    notify_recorder.clear()
+    bot.handle_obs_package_event(
+        'suse.obs.package.build_fail', {**msg, 'previouslyfailed': '1'}
+    )
+    assert notify_recorder == []
 
-    slacky.CONF = testing_CONF
 
-    with patch('slacky.datetime') as mock_datetime:
-        mock_datetime.now.return_value = datetime.datetime(2023, 1, 2)
+def test_obs_repo_publish(bot, notify_recorder):
+    with frozen_datetime() as clock:
+        clock.frozen = _DAY2
         bot.handle_obs_repo_event(
             'suse.obs.repo',
             {
@@ -188,22 +269,16 @@ def test_obs_repo_publish(mock_post_failure_notification):
         )
     assert len(bot.repo_publishes.keys()) == 1
     bot.check_pending_requests()
-    mock_post_failure_notification.assert_called_with(
+    assert notify_recorder[-1] == (
         ':published:',
         'SUSE:Containers:SLE-SERVER:15 / containers is not published after 0:55:00',
         'https://localhost/project/repository_state/SUSE:Containers:SLE-SERVER:15/containers',
     )
 
 
-@patch('slacky.post_failure_notification_to_slack', return_value=None)
-def test_obs_container_publish(mock_post_failure_notification):
-    bot = slacky.Slacky()
-    bot.repo_re = re.compile(r'^SUSE:Containers:SLE-SERVER:')
-
-    slacky.CONF = testing_CONF
-
-    with patch('slacky.datetime') as mock_datetime:
-        mock_datetime.now.return_value = datetime.datetime(2023, 1, 2)
+def test_obs_container_publish(bot, notify_recorder):
+    with frozen_datetime() as clock:
+        clock.frozen = _DAY2
         bot.handle_container_event(
             'suse.obs.container.published',
             {
@@ -224,96 +299,191 @@ def test_obs_container_publish(mock_post_failure_notification):
         )
 
     assert bot.container_publishes == {
-        'suse/nginx:1.21': datetime.datetime(2023, 1, 2),
-        'suse/sle15:15.5': datetime.datetime(2023, 1, 2),
+        'suse/nginx:1.21': _DAY2,
+        'suse/sle15:15.5': _DAY2,
     }
-    with patch('slacky.datetime') as mock_datetime:
-        mock_datetime.now.return_value = (
-            datetime.datetime(2023, 1, 2)
-            + slacky.HANGING_CONTAINER_TAG
-            + datetime.timedelta(minutes=5)
+    with frozen_datetime() as clock:
+        clock.frozen = (
+            _DAY2 + slacky.HANGING_CONTAINER_TAG + datetime.timedelta(minutes=5)
         )
         bot.check_pending_requests()
-        mock_post_failure_notification.assert_called_with(
+        assert notify_recorder[-1] == (
             ':question:',
             'These tags were not published after 10 days, 0:00:00: suse/nginx:1.21,suse/sle15:15.5',
             'https://registry.suse.com/',
         )
-    mock_post_failure_notification.reset_mock()
+    notify_recorder.clear()
     bot.check_pending_requests()
-    mock_post_failure_notification.assert_not_called()
+    assert notify_recorder == []
 
 
-@patch('slacky.post_failure_notification_to_slack', return_value=None)
-def test_openqa_failure(mock_post_failure_notification):
-    bot = slacky.Slacky()
+def _openqa_msg(arch: str, **fields) -> dict:
+    return {
+        'group_id': 444,
+        'BUILD': 'repo_23.2',
+        'ARCH': arch,
+        'TEST': 'TEST1',
+        **fields,
+    }
 
-    slacky.CONF = testing_CONF
 
-    with patch('slacky.datetime') as mock_datetime:
-        mock_datetime.now.return_value = datetime.datetime(2023, 1, 2)
-        body = (
-            '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1"}'
+def test_openqa_failure(bot, notify_recorder):
+    with frozen_datetime() as clock:
+        clock.frozen = _DAY2
+        bot.handle_openqa_event('suse.openqa.job.create', _openqa_msg('x86_64'))
+        bot.handle_openqa_event('suse.openqa.job.create', _openqa_msg('aarch64'))
+        bot.handle_openqa_event(
+            'suse.openqa.job.done', _openqa_msg('aarch64', result='failed')
         )
-        bot.handle_openqa_event('suse.openqa.job.create', json.loads(body))
-        body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "aarch64", "TEST": "TEST1"}'
-        bot.handle_openqa_event('suse.openqa.job.create', json.loads(body))
-        body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "aarch64", "TEST": "TEST1", "result": "failed"}'
-        bot.handle_openqa_event('suse.openqa.job.done', json.loads(body))
-        body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1", "result": "failed"}'
-        bot.handle_openqa_event('suse.openqa.job.done', json.loads(body))
-        body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "ppc64le", "TEST": "TEST1"}'
-        bot.handle_openqa_event('suse.openqa.job.created', json.loads(body))
-        mock_post_failure_notification.assert_not_called()
-        mock_datetime.now.return_value = datetime.datetime(
-            2023, 1, 2
-        ) + datetime.timedelta(minutes=3)
         bot.handle_openqa_event(
-            'suse.openqa.job.restart',
-            {'group_id': 444, 'BUILD': 'repo_23.2', 'ARCH': 'ppc64le', 'TEST': 'TEST1'},
+            'suse.openqa.job.done', _openqa_msg('x86_64', result='failed')
         )
+        bot.handle_openqa_event('suse.openqa.job.create', _openqa_msg('ppc64le'))
+        assert notify_recorder == []
+        clock.frozen = _DAY2 + datetime.timedelta(minutes=3)
+        bot.handle_openqa_event('suse.openqa.job.restart', _openqa_msg('ppc64le'))
 
-        mock_datetime.now.return_value = datetime.datetime(
-            2023, 1, 2
-        ) + datetime.timedelta(minutes=5)
-        body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "aarch64", "TEST": "TEST1", "result": "passed"}'
-        bot.handle_openqa_event('suse.openqa.job.done', json.loads(body))
-        body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1", "result": "failed"}'
-        bot.handle_openqa_event('suse.openqa.job.done', json.loads(body))
-        body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "ppc64le", "TEST": "TEST1", "result": "passed"}'
-        bot.handle_openqa_event('suse.openqa.job.done', json.loads(body))
+        clock.frozen = _DAY2 + datetime.timedelta(minutes=5)
+        bot.handle_openqa_event(
+            'suse.openqa.job.done', _openqa_msg('aarch64', result='passed')
+        )
+        bot.handle_openqa_event(
+            'suse.openqa.job.done', _openqa_msg('x86_64', result='failed')
+        )
+        bot.handle_openqa_event(
+            'suse.openqa.job.done', _openqa_msg('ppc64le', result='passed')
+        )
         bot.check_pending_requests()
-        mock_post_failure_notification.assert_not_called()
-
-    assert bot.openqa_jobs == collections.defaultdict(
-        list,
-        {
-            (444, 'repo_23.2'): [
-                slacky.openQAJob(
-                    test_id='TEST1/x86_64',
-                    build='repo_23.2',
-                    result='failed',
-                    finished_at=datetime.datetime(2023, 1, 2, 0, 5),
-                ),
-                slacky.openQAJob(
-                    test_id='TEST1/aarch64',
-                    build='repo_23.2',
-                    result='passed',
-                    finished_at=datetime.datetime(2023, 1, 2, 0, 5),
-                ),
-                slacky.openQAJob(
-                    test_id='TEST1/ppc64le',
-                    build='repo_23.2',
-                    result='passed',
-                    finished_at=datetime.datetime(2023, 1, 2, 0, 5),
-                ),
-            ]
-        },
-    )
+        assert notify_recorder == []
+
+    build = bot.openqa_jobs[(444, 'repo_23.2')]
+    assert build.results == {'pending': 0, 'failed': 1, 'passed': 2}
+    assert build.jobs == {
+        'TEST1/x86_64': slacky.openQAJob(
+            test_id='TEST1/x86_64',
+            build='repo_23.2',
+            result='failed',
+            finished_at=_DAY2 + datetime.timedelta(minutes=5),
+        ),
+        'TEST1/aarch64': slacky.openQAJob(
+            test_id='TEST1/aarch64',
+            build='repo_23.2',
+            result='passed',
+            finished_at=_DAY2 + datetime.timedelta(minutes=5),
+        ),
+        'TEST1/ppc64le': slacky.openQAJob(
+            test_id='TEST1/ppc64le',
+            build='repo_23.2',
+            result='passed',
+            finished_at=_DAY2 + datetime.timedelta(minutes=5),
+        ),
+    }
     bot.check_pending_requests()
-    mock_post_failure_notification.assert_called_with(
+    assert notify_recorder[-1] == (
         ':openqa:',
         'Build repo_23.2 has 1 failed tests.',
         'https://localhost/tests/overview?build=repo_23.2&groupid=444',
     )
     assert len(bot.openqa_jobs) == 0
+
+
+def test_dispatch_prefilters(bot, notify_recorder):
+    bot.dispatch(
+        'suse.openqa.job.create',
+        b'{"group_id":444,"BUILD":"repo_23.2","ARCH":"x86_64","TEST":"TEST1"}',
+    )
+    bot.dispatch(
+        'suse.openqa.job.create',
+        b'{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "s390x", "TEST": "TEST1"}',
+    )
+    bot.dispatch(
+        'suse.openqa.job.create',
+        b'{"group_id":1,"BUILD":"repo_23.2","ARCH":"x86_64","TEST":"TEST1"}',
+    )
+    assert list(bot.openqa_jobs) == [(444, 'repo_23.2')]
+    assert list(bot.openqa_jobs[(444, 'repo_23.2')].jobs) == [
+        'TEST1/x86_64',
+        'TEST1/s390x',
+    ]
+
+    body = (
+        b'{"project":"SUSE:SLE-15-SP6:Update:BCI","package":"test",'
+        b'"repository":"images","arch":"x86_64"}'
+    )
+    bot.dispatch('suse.obs.package.build_success', body)
+    assert notify_recorder == []
+    bot.dispatch('suse.obs.package.build_fail', body)
+    assert [status for status, _, _ in notify_recorder] == [':obs:']
+
+
+@pytest.mark.parametrize(
+    'body',
+    [
+        b'{"group_id" : 444, "BUILD": "repo_23.2"}',
+        b'{\n  "group_id":\n    444,\n  "BUILD": "repo_23.2"\n}',
+        b'{"group_id": "444", "BUILD": "repo_23.2"}',
+        b'{"BUILD": "repo_23.2"}',
+    ],
+    ids=['spaced', 'newlines', 'string', 'missing'],
+)
+def test_dispatch_openqa_prefilter_fails_open(bot, body):
+    handled = []
+    bot._dispatch['suse.openqa.job'] = lambda routing_key, msg: handled.append(msg)
+
+    bot.dispatch('suse.openqa.job.create', body)
+
+    assert handled == [json.loads(body)]
+
+
+def test_on_timer_sweeps_without_messages(bot, notify_recorder):
+    scheduled = []
+    bot._connection = SimpleNamespace(
+        ioloop=SimpleNamespace(call_later=lambda delay, cb: scheduled.append(cb))
+    )
+    bot.bs_requests = _bs_requests((1, 'project1', 'package1', _DAY2))
+    bot.next_interval_check = 0.0
+    with frozen_datetime() as clock:
+        clock.frozen = _DAY2 + datetime.timedelta(seconds=90)
+        bot.on_timer()
+    assert [status for status, _, _ in notify_recorder] == [':announcement:']
+    assert scheduled == [bot.on_timer]
+
+    # not due again before CHECK_INTERVAL has passed
+    bot.on_timer()
+    assert len(notify_recorder) == 1
+    assert len(scheduled) == 2
+
+
+def test_state_roundtrip(bot, tmp_path):
+    bot.openqa_jobs[(444, 'repo_23.2')].add_job(
+        slacky.openQAJob(test_id='TEST1/x86_64', build='repo_23.2', result='pending')
+    )
+    bot.bs_requests = _bs_requests((1, 'project1', 'package1', _DAY2))
+    bot.container_publishes = {'suse/sle15:15.5': _DAY2}
+
+    bot.save_state()
+    restored = slacky.Slacky()
+    restored.load_state()
+
+    assert restored.openqa_jobs == bot.openqa_jobs
+    assert restored.bs_requests == bot.bs_requests
+    assert restored.container_publishes == bot.container_publishes
+    assert list(tmp_path.iterdir()) == [tmp_path / 'state.pickle']
+
+
+@pytest.mark.parametrize(
+    'content',
+    [
+        b'',
+        pickle.dumps({'version': slacky.STATE_VERSION, 'bs_requests': {}})[:-10],
+        pickle.dumps({'bs_requests': {}, 'openqa_jobs': {}}),
+    ],
+    ids=['empty', 'truncated', 'unversioned'],
+)
+def test_load_state_ignores_unusable_file(bot, content):
+    slacky.STATE_FILE.write_bytes(content)
+
+    bot.load_state()
+
+    assert bot.bs_requests == {}
+    assert bot.openqa_jobs == {}